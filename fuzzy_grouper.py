@@ -1,15 +1,69 @@
+import os
 import re
 import sys
+import math
+import mmap
+import hashlib
 from difflib import SequenceMatcher
+from collections import Counter
+from functools import lru_cache, partial
+from itertools import repeat, combinations
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # Optional: a (much) faster, C++ implementation of fuzzy string matching
+    from rapidfuzz import process
+    from rapidfuzz.distance import Indel
+except ImportError:
+    process = Indel = None
 
 SIMILARITY_DIGITS = 3
 
+# Filters which may be applied to files to remove unimportant details before
+# comparison. These are applied as a series of regex substitution passes, each
+# given as a (replacement, [(filter name, regex), ...]) tuple. Where more than
+# one regex in a pass matches at the same point in a string, the first listed
+# wins.
+#
+# Python's regex engine can quickly skip ahead to places where a regex might
+# match when it starts with a known (set of) character(s). Alternatives which
+# don't (e.g. those starting with '^') defeat this for the whole regex and so
+# should be kept in their own pass.
+FILTER_PASSES = [
+    ("@", [
+        # Hex literals (e.g. 0x1234ABCD)
+        ("hex", r"0x[0-9a-f]+"),
+        # Numbers
+        ("numbers", r"[0-9]+(?:[.][0-9]+)?"),
+    ]),
+]
+
+# The "bars" filter (see shorten_bars()) is applied after the above.
+FILTER_NAMES = ("hex", "numbers", "bars")
+
+# Characters from which ASCII-art bars are made
+BAR_CHARS = "-=_~+!"
+
+# Maximum number of SequenceMatchers kept around (see fuzzy_grouper()). Each
+# holds an index many times larger than the file it was made for.
+MAX_CACHED_MATCHERS = 32
+
+# Length of the character n-grams whose SimHash fingerprints stand in for
+# files in accurate mode (see simhash())
+SIMHASH_NGRAM_LENGTH = 4
+
+# Total size of input files below which (unless --jobs is given) it isn't
+# worth starting processes to load and filter them
+PARALLEL_LOAD_MIN_BYTES = 4 * 1024 * 1024
+
 def fuzzy_grouper(files, similarity_threshold=0.90,
                   comparison_slice=slice(0, 1),
-                  status_line=None):
+                  status_line=None,
+                  accurate=False,
+                  max_simhash_distance=None):
     """Group together similar files.
     
-    Input: {"filename": "file-contents", ...}
+    Input: {"filename": "file-contents", ...} (contents may be str or bytes)
     
     Output: [["filename", ...], ["filename", ...]]
     
@@ -17,41 +71,261 @@ def fuzzy_grouper(files, similarity_threshold=0.90,
       considered part of the same group.
     * comparison_slice: Slice of items in a group to compare a new file
       with before also adding it to that group.
+    * accurate: If True, compare files character-by-character using
+      SequenceMatcher rather than by the set of lines they contain. See
+      similarity().
+    * max_simhash_distance: If not None, files whose simhash()es differ in
+      more than this many bits are assumed to be dissimilar without
+      comparing them in full. This is fast but approximate.
     """
+    # Internally, files are referred to by their index into these lists and
+    # groups are lists of these indices.
+    filenames = list(files)
+    contents = [files[filename] for filename in filenames]
+    
     groups = []
     
-    for i, (this_filename, this_content) in enumerate(files.items()):
+    # Files which are identical (common after filtering) are trivially
+    # similar; spot these by their digests instead. Each file is mapped to the
+    # first file with identical contents which then stands in for it in all
+    # comparisons.
+    first_with_digest = {}
+    first_with_object = {}  # {id(content): file, ...}
+    canonical = []
+    for file, content in enumerate(contents):
+        # Identical contents are often a single shared object (see main())
+        # which needn't be hashed again.
+        first = first_with_object.get(id(content))
+        if first is None:
+            first = first_with_digest.setdefault(content_digest(content), file)
+            first_with_object[id(content)] = first
+        canonical.append(first)
+    
+    # When a file has duplicates, each duplicate will be compared against
+    # (many of) the same groups. The results of comparisons made for such
+    # files are kept here to avoid repeating them. {(file, file): bool, ...}
+    duplicated = set(file
+                     for file, count in Counter(canonical).items()
+                     if count > 1)
+    known_similar = {}
+    
+    if max_simhash_distance is not None:
+        # Accurate comparisons are character-by-character and so should be
+        # approximated by fingerprints of character n-grams, not lines.
+        ngram_length = SIMHASH_NGRAM_LENGTH if accurate else None
+        simhashes = [simhash(content, ngram_length) for content in contents]
+    
+    # The (canonical) first files of the groups at the front of the list
+    # (i.e. the largest groups which are compared against most often)
+    front_files = set()
+    
+    # Is the first file in each group always compared against?
+    compares_first = comparison_slice.start in (None, 0)
+    
+    # If set, find_candidates(file) gives a set of files, one of which must be
+    # the first file in a group for that group to possibly match.
+    # add_representative(file) must be called when a new group is created.
+    find_candidates = add_representative = None
+    
+    if accurate:
+        # SequenceMatcher's ratio() is 2*M/T where M is the number of
+        # matching characters and T the combined length of both strings.
+        # Since M can be at most the length of the shorter string, files
+        # whose lengths differ too much can be rejected without constructing
+        # a SequenceMatcher at all.
+        file_lens = [len(content) for content in contents]
+        
+        def lengths_similar(this_file, other_file):
+            this_len = file_lens[this_file]
+            other_len = file_lens[other_file]
+            return (2 * min(this_len, other_len) >=
+                    similarity_threshold * (this_len + other_len))
+    
+    if accurate and Indel is not None:
+        # The normalised Indel similarity is also 2*M/T (where M is the length
+        # of the longest common subsequence) and, given a cutoff, gives up as
+        # soon as it can't be reached.
+        def similar(this_file, other_file):
+            if not lengths_similar(this_file, other_file):
+                return False
+            
+            score = Indel.normalized_similarity(
+                contents[this_file],
+                contents[other_file],
+                score_cutoff=similarity_threshold)
+            return score >= similarity_threshold
+    elif accurate:
+        # SequenceMatcher indexes its second sequence when it is set (and
+        # counts its characters for quick_ratio() when first used). Since the
+        # first file in each group is compared against many new files, keep
+        # a SequenceMatcher (with the file as its second sequence) around for
+        # the first files of the front-most groups so this work is only done
+        # once. These indices are many times larger than the files themselves
+        # so only MAX_CACHED_MATCHERS are kept.
+        matchers = {}
+        
+        def similar(this_file, other_file):
+            if not lengths_similar(this_file, other_file):
+                return False
+            
+            sm = matchers.get(other_file)
+            if sm is None:
+                sm = SequenceMatcher(None, autojunk=False)
+                sm.set_seq2(contents[other_file])
+                if other_file in front_files:
+                    # Drop matchers for groups no longer at the front
+                    for file in [file for file in matchers
+                                 if file not in front_files]:
+                        del matchers[file]
+                    matchers[other_file] = sm
+            sm.set_seq1(contents[this_file])
+            
+            # quick_ratio() is an upper bound on ratio() based on counting
+            # characters in common, which is linear rather than quadratic time
+            if sm.quick_ratio() < similarity_threshold:
+                return False
+            
+            return sm.ratio() >= similarity_threshold
+    else:
+        line_sets = [line_set(content) for content in contents]
+        
+        def similar(this_file, other_file):
+            this_lines = line_sets[this_file]
+            other_lines = line_sets[other_file]
+            # The Jaccard index can be no more than the ratio of the sizes of
+            # the two sets.
+            if (min(len(this_lines), len(other_lines)) <
+                    similarity_threshold * max(len(this_lines),
+                                               len(other_lines))):
+                return False
+            
+            return (jaccard_index(this_lines, other_lines) >=
+                    similarity_threshold)
+        
+        if similarity_threshold > 0 and compares_first:
+            # Two sets with a Jaccard index of at least t must share at least
+            # ceil(t*n) of the n lines in either set. As a consequence, if the
+            # lines of every set are sorted into the same order, any two
+            # similar sets must have a line in common amongst the first
+            # n - ceil(t*n) + 1 lines of each (their 'prefix'). An index of
+            # the prefixes of the first file in each group gives the only
+            # groups worth comparing against. Ordering lines rarest-first
+            # keeps this index selective.
+            frequency = Counter(line for lines in line_sets for line in lines)
+            prefix_index = {}  # {line: [file, ...], ...}
+            empty_representatives = set()
+            
+            def prefix(file):
+                lines = line_sets[file]
+                # NB: One longer than necessary to be safe from rounding
+                length = (len(lines) + 2 -
+                          int(math.ceil(similarity_threshold * len(lines))))
+                return sorted(lines,
+                              key=lambda line: (frequency[line], line))[:length]
+            
+            def prefix_candidates(this_file):
+                if not line_sets[this_file]:
+                    # Empty files are only similar to other empty files
+                    return empty_representatives
+                
+                candidates = set()
+                for line in prefix(this_file):
+                    candidates.update(prefix_index.get(line, ()))
+                return candidates
+            
+            def add_prefixes(file):
+                if not line_sets[file]:
+                    empty_representatives.add(file)
+                for line in prefix(file):
+                    prefix_index.setdefault(line, []).append(file)
+            
+            find_candidates = prefix_candidates
+            add_representative = add_prefixes
+    
+    def files_similar(this_file, other_file):
+        if (max_simhash_distance is not None and
+                (simhashes[this_file] ^
+                 simhashes[other_file]).bit_count() >
+                max_simhash_distance):
+            # Probably not similar
+            return False
+        
+        return similar(this_file, other_file)
+    
+    def group_matches(this_file, other_files):
+        this_file = canonical[this_file]
+        for other_file in other_files:
+            other_file = canonical[other_file]
+            if this_file == other_file:
+                # Identical files
+                continue
+            
+            if this_file in duplicated:
+                key = (this_file, other_file)
+                match = known_similar.get(key)
+                if match is None:
+                    match = known_similar[key] = files_similar(this_file,
+                                                               other_file)
+            else:
+                match = files_similar(this_file, other_file)
+            
+            if not match:
+                # This group doesn't match, give up
+                return False
+        return True
+    
+    for this_file in range(len(filenames)):
         if status_line:
             status_line.update("Comparing file {} of {} against {} group{}...".format(
-                i,
-                len(files),
+                this_file,
+                len(filenames),
                 len(groups),
                 "s" if len(groups) != 1 else ""))
-        for group in groups:
-            for other_filename in group[comparison_slice]:
-                other_content = files[other_filename]
-                sm = SequenceMatcher(None,
-                                     this_content,
-                                     other_content,
-                                     autojunk=False)
-                if (sm.real_quick_ratio() < similarity_threshold
-                        or sm.ratio() < similarity_threshold):
-                    # This group doesn't match, give up
-                    break
-            else:
+        
+        if find_candidates is not None:
+            candidates = find_candidates(this_file)
+            group_indices = [index for index, group in enumerate(groups)
+                             if group[0] in candidates]
+        else:
+            group_indices = range(len(groups))
+        
+        if max_simhash_distance is not None and compares_first:
+            # Discard groups whose first file's SimHash is too distant in one
+            # tight loop (rather than one function call per group).
+            this_simhash = simhashes[this_file]
+            group_indices = [
+                index for index in group_indices
+                if ((this_simhash ^ simhashes[groups[index][0]]).bit_count() <=
+                    max_simhash_distance)]
+        
+        for index in group_indices:
+            if group_matches(this_file, groups[index][comparison_slice]):
                 # This group does match! Join it!
-                group.append(this_filename)
+                group = groups[index]
+                group.append(this_file)
+                
+                # Keep the largest group first since this one is most likely
+                # to match future groups. Since groups are kept sorted (and
+                # this one has only grown by one) just move it ahead of any
+                # groups which are now smaller, preserving the existing order
+                # of equally sized groups.
+                while index > 0 and len(groups[index - 1]) < len(group):
+                    groups[index - 1], groups[index] = group, groups[index - 1]
+                    index -= 1
                 break
         else:
             # No group contains anything similar, start a new group
-            groups.append([this_filename])
+            groups.append([this_file])
+            if add_representative is not None:
+                add_representative(this_file)
             if status_line:
                 status_line.append(
-                    "Created new group for {}".format(this_filename))
+                    "Created new group for {}".format(filenames[this_file]))
         
-        # Keep the largest group first since this one is most likely to match
-        # future groups
-        groups.sort(key=len, reverse=True)
+        # NB: Groups may have been created or reordered
+        front_files.clear()
+        front_files.update(canonical[group[0]]
+                           for group in groups[:MAX_CACHED_MATCHERS])
     
     if status_line:
         status_line.update("")
@@ -60,25 +334,250 @@ def fuzzy_grouper(files, similarity_threshold=0.90,
                 len(groups),
                 "s" if len(groups) != 1 else ""))
     
-    return groups
+    return [[filenames[file] for file in group] for group in groups]
+
+
+def similarity(a, b, accurate=False):
+    """Compute the similarity of two strings as a score between 0.0 and 1.0.
+    
+    By default this is the Jaccard index of the sets of lines in each string.
+    This is very fast but only considers lines which are identical.
+    
+    If accurate is True, the SequenceMatcher ratio is used instead. This
+    compares strings character-by-character and so can spot lines which are
+    merely similar but takes time quadratic in the length of the strings. If
+    rapidfuzz is installed, its (similar but not identical) normalised Indel
+    similarity is used instead since it is very much faster.
+    """
+    if accurate and Indel is not None:
+        return Indel.normalized_similarity(a, b)
+    elif accurate:
+        return SequenceMatcher(None, a, b, autojunk=False).ratio()
+    else:
+        return jaccard_index(line_set(a), line_set(b))
 
 
+def similarity_matrix(strings, accurate=False, workers=1):
+    """Compute the similarity (see similarity()) of every pair of strings.
+    
+    Since the similarity matrix is symmetric, only its upper triangle is
+    computed. This is returned in condensed form: a flat list of the scores
+    for each pair (i, j) where i < j, in the order produced by
+    itertools.combinations(range(len(strings)), 2).
+    
+    * workers: Number of threads to use when rapidfuzz is in use.
+    """
+    pairs = list(combinations(range(len(strings)), 2))
+    
+    if accurate and process is not None:
+        try:
+            if hasattr(process, "cpdist"):
+                # Compare the pairs element-wise (rapidfuzz 3.6+)
+                return process.cpdist([strings[i] for i, _ in pairs],
+                                      [strings[j] for _, j in pairs],
+                                      scorer=Indel.normalized_similarity,
+                                      workers=workers).tolist()
+            else:
+                matrix = process.cdist(strings, strings,
+                                       scorer=Indel.normalized_similarity,
+                                       workers=workers)
+                return [float(matrix[i, j]) for i, j in pairs]
+        except ImportError:
+            # cdist/cpdist require numpy; fall back on comparing pairs one at
+            # a time
+            pass
+    
+    if accurate:
+        items = strings
+        score = lambda a, b: similarity(a, b, True)
+    else:
+        items = [line_set(s) for s in strings]
+        score = jaccard_index
+    
+    return [score(items[i], items[j]) for i, j in pairs]
+
+
+def line_set(s):
+    """Return the set of (hashes of) lines in a string."""
+    return frozenset(hash(line) for line in s.splitlines())
+
+
+def jaccard_index(a, b):
+    """Compute the Jaccard index of two sets."""
+    intersection = len(a & b)
+    union = len(a) + len(b) - intersection
+    if union:
+        return intersection / union
+    else:
+        # Two empty sets
+        return 1.0
+
+
+def simhash(s, ngram_length=None):
+    """Compute a 64-bit SimHash fingerprint of the set of lines of a string.
+    
+    The more lines two strings share, the fewer bits their fingerprints are
+    likely to differ by.
+    
+    If ngram_length is given, the set of (overlapping) character n-grams of
+    that length is used instead of the set of lines. Small edits within a
+    line then only change a few features rather than the whole line, better
+    reflecting character-by-character similarity.
+    """
+    if isinstance(s, str):
+        s = s.encode("utf-8", "surrogatepass")
+    
+    if ngram_length is None:
+        features = set(s.splitlines())
+    else:
+        features = set(s[i:i + ngram_length]
+                       for i in range(max(1, len(s) - ngram_length + 1)))
+    
+    # NB: Python's hash() is salted per process so a proper hash is used to
+    # keep fingerprints (and so results) consistent between runs.
+    hashes = [hashlib.blake2b(feature, digest_size=8).hexdigest()
+              for feature in features]
+    
+    # Each bit of the fingerprint is set if that bit is set in the hashes of
+    # the majority of features. The 64-bit binary representations of these
+    # hashes are concatenated so that each bit can be counted in one go by
+    # taking every 64th character.
+    bits = "".join(format(int(h, 16), "064b") for h in hashes)
+    fingerprint = 0
+    for bit in range(64):
+        if bits[bit::64].count("1") * 2 > len(hashes):
+            fingerprint |= 1 << (63 - bit)
+    return fingerprint
+
+
+def content_digest(s):
+    """Compute a digest of a string (or bytes), used to cheaply spot identical
+    files.
+    """
+    if isinstance(s, str):
+        s = s.encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(s, digest_size=16).digest()
+
+
+@lru_cache()
+def compile_filters(names, binary=False):
+    """Compile the passes needed to apply the named filters into a list of
+    functions, each taking and returning a string. If binary is True, these
+    will work on bytes rather than str.
+    """
+    passes = []
+    for replacement, filters in FILTER_PASSES:
+        patterns = [pattern for name, pattern in filters if name in names]
+        if patterns:
+            pattern = "|".join(patterns)
+            if binary:
+                pattern = pattern.encode("ascii")
+                replacement = replacement.encode("ascii")
+            regex = re.compile(pattern, flags=re.IGNORECASE | re.MULTILINE)
+            passes.append(partial(regex.sub, replacement))
+    if "bars" in names:
+        passes.append(shorten_bars)
+    return passes
+
+def apply_filters(s, names=FILTER_NAMES):
+    """Apply the named filters (see FILTER_PASSES) to a string. Anything other
+    than a str (e.g. bytes or an mmap) is filtered as bytes.
+    """
+    for filter_pass in compile_filters(frozenset(names),
+                                       not isinstance(s, str)):
+        s = filter_pass(s)
+    return s
+
+def shorten_bars(s):
+    """Replace bars made of BAR_CHARS at the start of a line and followed by a
+    space, or at the end of a line and preceded by a space, with "=".
+    
+    This is equivalent to substituting the (multi-line) regexes
+    r"^[-=_~+!]+ " and then r" [-=_~+!]+$" with "=" but, since only the
+    ends of each line need checking, is quite a bit faster.
+    """
+    if isinstance(s, str):
+        bar_chars, newline, space, bar = BAR_CHARS, "\n", " ", "="
+    else:
+        s = bytes(s)
+        bar_chars, newline, space, bar = (BAR_CHARS.encode("ascii"),
+                                          b"\n", b" ", b"=")
+    # NB: Indexing bytes produces ints, hence turning bar_chars into a set of
+    # whatever indexing produces.
+    bar_char_set = set(bar_chars)
+    
+    lines = s.split(newline)
+    for i, line in enumerate(lines):
+        if not line or (line[0] not in bar_char_set and
+                        line[-1] not in bar_char_set):
+            continue
+        
+        prefix = line[:0]
+        head = line.lstrip(bar_chars)
+        if len(head) != len(line) and head[:1] == space:
+            prefix = bar
+            line = head[1:]
+        
+        tail = line.rstrip(bar_chars)
+        if len(tail) != len(line) and tail[-1:] == space:
+            line = tail[:-1] + bar
+        
+        lines[i] = prefix + line
+    return newline.join(lines)
+
+def load_file(filename, names=FILTER_NAMES):
+    """Read a file and apply the named filters (see FILTER_PASSES) to it.
+    Returns bytes.
+    """
+    with open(filename, "rb") as f:
+        try:
+            # Filter straight out of the page cache rather than reading (and
+            # decoding) a copy of the file first.
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files (and things which aren't files) can't be mapped
+            return bytes(apply_filters(normalise_newlines(f.read()), names))
+        with data:
+            if data.find(b"\r") != -1:
+                # Line endings must be normalised (e.g. so that bars at the
+                # ends of lines are found) which needs a copy of the file.
+                data = normalise_newlines(data[:])
+            return bytes(apply_filters(data, names))
+
+def normalise_newlines(data):
+    """Convert CRLF and lone CR line endings in bytes to LF, as reading a file
+    in text mode (with universal newlines) would.
+    """
+    return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+def total_file_size(filenames):
+    """Return the combined size, in bytes, of the named files. Files which
+    can't be accessed are counted as empty.
+    """
+    size = 0
+    for filename in filenames:
+        try:
+            size += os.path.getsize(filename)
+        except OSError:
+            pass
+    return size
+
 def remove_hex(s):
     """Remove all hex literals (e.g. 0x1234ABCD) from a string."""
-    return re.sub(r"0x[0-9a-f]+", "@", s, flags=re.IGNORECASE)
+    return apply_filters(s, ("hex", ))
 
 def remove_numbers(s):
     """Remove all numbers from a string."""
-    return re.sub(r"[0-9]+([.][0-9]+)?", "@", s, flags=re.IGNORECASE)
+    return apply_filters(s, ("numbers", ))
 
 def remove_bars(s):
     """Shorten all long bars which vary in length when different numbers are
     present.
     """
-    return re.sub(r"(^[-=_~+!]+ | [-=_~+!]+$)", "=", s, flags=re.MULTILINE)
+    return apply_filters(s, ("bars", ))
 
 def filter_string(s):
-    return remove_hex(remove_numbers(remove_bars(s)))
+    return apply_filters(s)
 
 class StatusLine(object):
     
@@ -133,6 +632,31 @@ def main():
                              "this option significantly slows down this "
                              "program.")
     
+    parser.add_argument("--accurate", "-a", action="store_true",
+                        help="If set, files are compared character-by-"
+                             "character rather than line-by-line. This "
+                             "allows lines which differ slightly to be "
+                             "considered similar but is very much slower.")
+    
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="Number of processes to use to load and "
+                             "filter files and (when rapidfuzz is "
+                             "installed) threads to use to compute the "
+                             "--accurate similarity matrix. Defaults to the "
+                             "number of CPUs, though files are only loaded "
+                             "in parallel by default when there are several "
+                             "megabytes of them.")
+    
+    parser.add_argument("--max-simhash-distance", "-H", type=int,
+                        metavar="BITS",
+                        help="If set, files whose (64-bit) SimHash "
+                             "fingerprints differ by more than this many "
+                             "bits are assumed to be dissimilar without "
+                             "comparing them in full. This speeds up "
+                             "grouping at the risk of failing to group some "
+                             "similar files. Fingerprints are of lines or, "
+                             "with --accurate, of 4-character sequences.")
+    
     parser.add_argument("--keep-numbers", "-n", action="store_true",
                         help="If set, numbers are not stripped from files "
                              "before comparison.")
@@ -169,35 +693,59 @@ def main():
     else:
         status_line = None
     
-    filter_bank = []
+    filter_names = []
     if not args.keep_numbers:
-        filter_bank.append(remove_numbers)
+        filter_names.append("numbers")
     if not args.keep_hex:
-        filter_bank.append(remove_hex)
+        filter_names.append("hex")
     if not args.keep_ascii_bars:
-        filter_bank.append(remove_bars)
+        filter_names.append("bars")
+    
+    jobs = args.jobs if args.jobs is not None else os.cpu_count() or 1
+    
+    # Starting processes costs more than it saves when there is little to
+    # filter (and --score and --normalise only ever load one or two files).
+    if args.score or args.normalise:
+        load_jobs = 1
+    elif (args.jobs is None and
+            total_file_size(filenames) < PARALLEL_LOAD_MIN_BYTES):
+        load_jobs = 1
+    else:
+        load_jobs = jobs
     
     if status_line:
         status_line.update(
             "Filtering {} files...".format(len(filenames)))
-    files = {}
-    for filename in filenames:
-        with open(filename, "r") as f:
-            s = f.read()
-        for fn in filter_bank:
-            s = fn(s)
-        files[filename] = s
+    if load_jobs > 1 and len(filenames) > 1:
+        # Filtering is CPU bound (and holds the GIL) so use processes. Files
+        # are sent to workers in chunks to amortise the cost of communicating
+        # with them.
+        with ProcessPoolExecutor(load_jobs) as executor:
+            contents = list(executor.map(
+                load_file,
+                filenames,
+                repeat(filter_names),
+                chunksize=max(1, len(filenames) // (load_jobs * 4))))
+    else:
+        contents = [load_file(filename, filter_names)
+                    for filename in filenames]
+    
+    # Log files frequently become identical once filtered so keep just one
+    # copy of each distinct filtered file.
+    unique_contents = {}
+    files = {filename: unique_contents.setdefault(content, content)
+             for filename, content in zip(filenames, contents)}
+    del contents, unique_contents
     
     if args.normalise:
-        sys.stdout.write(files[args.normalise[0]])
+        sys.stdout.buffer.write(files[args.normalise[0]])
         return 0
     
     if args.score:
         file_0 = files[args.score[0]]
         file_1 = files[args.score[1]]
         
-        sm = SequenceMatcher(None, file_0, file_1, autojunk=False)
-        print(sm.ratio())
+        print(similarity(file_0, file_1, args.accurate))
         return 0
 
     if args.compare_whole_group:
@@ -209,7 +757,9 @@ def main():
     groups = fuzzy_grouper(files,
                            args.threshold,
                            comparison_slice,
-                           status_line)
+                           status_line,
+                           args.accurate,
+                           args.max_simhash_distance)
     
     if args.summary_only:
         print("\n\n".join(
@@ -221,31 +771,33 @@ def main():
         print("\n\n".join("\n".join(group) for group in groups))
     
     if args.print_similarity_matrix:
-        print("")
+        scores = similarity_matrix([files[group[0]] for group in groups],
+                                   args.accurate,
+                                   jobs)
         
-        # Print column numbers
-        line = "{:{}s} ".format("GROUP", SIMILARITY_DIGITS+2)
-        for j in range(len(groups)):
-            line += "{:{}d} ".format(j, SIMILARITY_DIGITS+2)
-        print(line)
+        width = SIMILARITY_DIGITS + 2
+        formatted_scores = iter(["{:1.{}f}".format(score, SIMILARITY_DIGITS)
+                                 for score in scores])
+        diagonal = "{:1.{}f}".format(1.0, SIMILARITY_DIGITS)
+        blank = " " * width
         
-        for i, group_a in enumerate(groups):
-            # Row number
-            line = "{:{}d} ".format(i, SIMILARITY_DIGITS+2)
-            
-            # Row contents
-            for j, group_b in enumerate(groups):
-                if j > i:
-                    sm = SequenceMatcher(None,
-                                         files[group_a[0]],
-                                         files[group_b[0]],
-                                         autojunk=False)
-                    line += "{:1.{}f} ".format(sm.ratio(), SIMILARITY_DIGITS)
-                elif j == i:
-                    line += "{:1.{}f} ".format(1.0, SIMILARITY_DIGITS)
-                else:
-                    line += " "*(2 + SIMILARITY_DIGITS + 1)
-            print(line)
+        # Column numbers
+        lines = [" ".join(["{:{}s}".format("GROUP", width)] +
+                          ["{:{}d}".format(j, width)
+                           for j in range(len(groups))])]
+        
+        for i in range(len(groups)):
+            # Row number, blanks for the lower triangle, then the scores (which
+            # are given in the same order we print them)
+            lines.append(" ".join(
+                ["{:{}d}".format(i, width)] +
+                [blank] * i +
+                [diagonal] +
+                [next(formatted_scores) for _ in range(len(groups) - i - 1)]))
+        
+        # Written in one go after a blank line; NB: every cell (including the
+        # last in each row) is followed by a space
+        sys.stdout.write("\n" + "".join(line + " \n" for line in lines))
     
 
 if __name__ == "__main__":